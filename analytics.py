@@ -0,0 +1,275 @@
+"""
+Offline analytics over stored states and the transition log.
+
+The log is read in fixed-size chunks into NumPy arrays, so memory use is
+bounded by the chunk size plus a fixed amount of carried state per entity
+(see MachineStats).
+
+    python analytics.py transitions.log --shelve shelve \\
+        --funnel documents Draft,Validated,Approved,Published
+"""
+import argparse
+import dbm
+from itertools import islice
+import shelve
+
+import numpy as np
+
+import machines
+from registry import registry
+from store import ColdStore
+
+
+LOG_DTYPE = np.dtype([
+    ('time', 'f8'),
+    ('name', 'U32'),
+    ('pk', 'U36'),
+    ('state0', 'i4'),
+    ('event', 'i4'),
+    ('state1', 'i4'),
+])
+
+# Log-spaced duration buckets from a millisecond to about four months.
+DURATION_EDGES = np.logspace(-3, 7, 101)
+
+
+def read_chunks(filename, chunk_size=100000):
+    """
+    Yield the transition log as structured arrays of at most chunk_size rows.
+    """
+    with open(filename) as f:
+        while True:
+            lines = list(islice(f, chunk_size))
+            if not lines:
+                return
+            yield np.loadtxt(lines, dtype=LOG_DTYPE, delimiter=',', ndmin=1)
+
+
+def read_states(filename, cold=None, chunk_size=100000):
+    """
+    Yield (names, states) arrays for the current state of each stored entity.
+
+    Entities in the cold store, if given and present, are included too.
+    """
+    db = shelve.open(filename, flag='r')
+    try:
+        yield from _read_states(db.keys(), db.__getitem__, chunk_size)
+        if cold is None:
+            return
+        try:
+            store = ColdStore(cold, flag='r')
+        except dbm.error:
+            return
+        try:
+            keys = (k for k in store.keys() if k not in db)
+            yield from _read_states(keys, store.get, chunk_size)
+        finally:
+            store.close()
+    finally:
+        db.close()
+
+
+def _read_states(keys, get, chunk_size):
+    keys = iter(keys)
+    while True:
+        batch = list(islice(keys, chunk_size))
+        if not batch:
+            return
+        names = np.array([k.split(':', 1)[0] for k in batch])
+        states = np.array([int(get(k)['state']) for k in batch], dtype='i4')
+        yield names, states
+
+
+class MachineStats(object):
+    """
+    Running aggregates for a single registered machine.
+
+    counts[state0, event] is the number of transitions taken, durations is a
+    histogram over DURATION_EDGES of the time spent in each state before
+    leaving it, and the carry arrays hold, for every entity seen so far and
+    sorted by pk, its last transition time, current state and a bitmask of
+    the states it has visited. State values must therefore be below 64.
+
+    The carry arrays take 164 bytes per entity, so memory grows with
+    the number of entities E as well as the chunk size n. Each chunk costs
+    O(n log n) to sort and look up, plus one O(E) copy when it introduces
+    entities not seen before.
+    """
+
+    def __init__(self, name):
+        fsm = registry[name]().fsm
+        self.name = name
+        self.states = fsm.states
+        self.events = fsm.events
+        self.nstates = max(s.value for s in fsm.states) + 1
+        self.nevents = max(e.value for e in fsm.events) + 1
+        self.counts = np.zeros((self.nstates, self.nevents), dtype='i8')
+        self.durations = np.zeros((self.nstates, len(DURATION_EDGES) + 1), dtype='i8')
+        self.pks = np.empty(0, dtype='U36')
+        self.times = np.empty(0, dtype='f8')
+        self.current = np.empty(0, dtype='i4')
+        self.visited = np.empty(0, dtype='u8')
+
+    def add(self, chunk):
+        moves = chunk[chunk['event'] > 0]
+        np.add.at(self.counts, (moves['state0'], moves['event']), 1)
+
+        order = np.argsort(chunk['pk'], kind='stable')
+        rows = chunk[order]
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = rows['pk'][1:] != rows['pk'][:-1]
+        starts = np.flatnonzero(first)
+        last = np.append(starts[1:] - 1, len(rows) - 1)
+
+        entered = np.full(len(rows), np.nan)
+        entered[1:] = rows['time'][:-1]
+        pos = np.searchsorted(self.pks, rows['pk'][starts])
+        known = pos < len(self.pks)
+        known[known] = self.pks[pos[known]] == rows['pk'][starts][known]
+        entered[starts] = np.nan
+        entered[starts[known]] = self.times[pos[known]]
+
+        timed = (rows['event'] > 0) & ~np.isnan(entered)
+        elapsed = rows['time'][timed] - entered[timed]
+        buckets = np.digitize(elapsed, DURATION_EDGES)
+        np.add.at(self.durations, (rows['state0'][timed], buckets), 1)
+
+        bits = (np.left_shift(np.uint64(1), rows['state0'].astype('u8')) |
+                np.left_shift(np.uint64(1), rows['state1'].astype('u8')))
+        visited = np.bitwise_or.reduceat(bits, starts)
+        visited[known] |= self.visited[pos[known]]
+
+        self.times[pos[known]] = rows['time'][last[known]]
+        self.current[pos[known]] = rows['state1'][last[known]]
+        self.visited[pos[known]] = visited[known]
+        # New pks are already sorted, so they can be spliced in place.
+        fresh = ~known
+        at = pos[fresh]
+        self.pks = np.insert(self.pks, at, rows['pk'][starts[fresh]])
+        self.times = np.insert(self.times, at, rows['time'][last[fresh]])
+        self.current = np.insert(self.current, at, rows['state1'][last[fresh]])
+        self.visited = np.insert(self.visited, at, visited[fresh])
+
+    def transitions(self):
+        """
+        Return (state0, event, count) for every transition taken, most common first.
+        """
+        state0, event = np.nonzero(self.counts)
+        count = self.counts[state0, event]
+        order = np.argsort(-count, kind='stable')
+        return [(self.states(int(s)), self.events(int(e)), int(c))
+                for s, e, c in zip(state0[order], event[order], count[order])]
+
+    def time_in_state(self, quantiles=(0.5, 0.9, 0.99)):
+        """
+        Return {state: (count, [upper bound of each quantile in seconds])}.
+
+        Quantiles are read off the duration histogram, so they are accurate
+        to the width of one bucket.
+        """
+        upper = np.append(DURATION_EDGES, np.inf)
+        result = {}
+        for value, hist in enumerate(self.durations):
+            total = int(hist.sum())
+            if total == 0:
+                continue
+            cumulative = np.cumsum(hist)
+            ranks = np.ceil(np.array(quantiles) * total)
+            idx = np.searchsorted(cumulative, ranks)
+            result[self.states(value)] = (total, [float(upper[i]) for i in idx])
+        return result
+
+    def funnel(self, steps):
+        """
+        Return (state, entities, conversion) for each step of a funnel.
+
+        An entity counts at a step if it has visited that state and every
+        earlier step. Conversion is relative to the previous step.
+        """
+        mask = np.uint64(0)
+        result = []
+        previous = None
+        for step in steps:
+            mask |= np.uint64(1) << np.uint64(int(step))
+            reached = int(np.count_nonzero((self.visited & mask) == mask))
+            rate = reached / previous if previous else 1.0
+            result.append((step, reached, rate))
+            previous = reached
+        return result
+
+
+def analyze(filename, chunk_size=100000):
+    """
+    Stream the transition log and return {machine name: MachineStats}.
+    """
+    stats = {}
+    for chunk in read_chunks(filename, chunk_size):
+        for name in map(str, np.unique(chunk['name'])):
+            if name not in registry:
+                continue
+            if name not in stats:
+                stats[name] = MachineStats(name)
+            stats[name].add(chunk[chunk['name'] == name])
+    return stats
+
+
+def state_counts(filename, cold=None, chunk_size=100000):
+    """
+    Return {machine name: {state: count}} for the entities in a shelve and
+    its cold store.
+    """
+    totals = {}
+    for names, states in read_states(filename, cold, chunk_size):
+        for name in map(str, np.unique(names)):
+            counts = np.bincount(states[names == name])
+            total = totals.setdefault(name, np.zeros(0, dtype='i8'))
+            if len(counts) > len(total):
+                total = np.pad(total, (0, len(counts) - len(total)))
+            total[:len(counts)] += counts
+            totals[name] = total
+    result = {}
+    for name, total in totals.items():
+        states = registry[name]().fsm.states if name in registry else None
+        result[name] = dict((states(int(v)) if states else int(v), int(c))
+                            for v, c in enumerate(total) if c)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('log', help='transition log written by the app')
+    parser.add_argument('--shelve', help='shelve database to count current states from')
+    parser.add_argument('--cold', help='cold store of the shelve (default: SHELVE-cold)')
+    parser.add_argument('--chunk-size', type=int, default=100000)
+    parser.add_argument('--funnel', nargs=2, action='append', default=[],
+                        metavar=('MACHINE', 'STATES'),
+                        help='comma-separated states to report conversion through')
+    args = parser.parse_args(argv)
+
+    stats = analyze(args.log, args.chunk_size)
+    for name in sorted(stats):
+        s = stats[name]
+        print('%s: %d entities' % (name, len(s.pks)))
+        print('  transitions:')
+        for state0, event, count in s.transitions():
+            print('    %-16s %-12s %d' % (state0.name, event.name, count))
+        print('  time in state (count, p50/p90/p99 seconds):')
+        for state, (count, q) in sorted(s.time_in_state().items()):
+            print('    %-16s %8d  %s' % (state.name, count, ' / '.join('%.3g' % x for x in q)))
+
+    for name, steps in args.funnel:
+        s = stats.get(name) or MachineStats(name)
+        print('%s funnel:' % name)
+        for state, reached, rate in s.funnel([s.states[x] for x in steps.split(',')]):
+            print('  %-16s %8d  %6.1f%%' % (state.name, reached, rate * 100))
+
+    if args.shelve:
+        for name, counts in sorted(state_counts(
+                args.shelve, args.cold or args.shelve + '-cold', args.chunk_size).items()):
+            print('%s current states:' % name)
+            for state, count in sorted(counts.items()):
+                print('  %-16s %d' % (getattr(state, 'name', state), count))
+
+
+if __name__ == '__main__':
+    main()
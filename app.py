@@ -1,43 +1,127 @@
 from contextlib import closing
 import io
+import json
 import logging
 from operator import itemgetter
 import os
 from pickle import HIGHEST_PROTOCOL
-import shelve
+import threading
+import time
 import urllib
 import uuid
 
-from flask import abort, Flask, jsonify, redirect, render_template, send_file, url_for
+from flask import abort, Flask, jsonify, redirect, render_template, request, send_file, url_for
 import graphviz as gv
 
+import codegen
 import machines
 from registry import registry
+from store import ColdStore, Durability, TransitionLog, WriteBehindStore
 
 
 SHELVE_DB = 'shelve'
+SHELVE_DURABILITY = Durability.Group
+SHELVE_MAX_PENDING = 256
+SHELVE_MAX_DELAY = 1.0
+TRANSITION_LOG = 'transitions.log'
+COLD_STORE_DB = 'shelve-cold'
+ENTITY_TTL = 24 * 60 * 60
+COLD_AFTER = 60 * 60
+SWEEP_INTERVAL = 60
+ACCESS_RESOLUTION = 60
+DISPATCH_CACHE = 'generated'
+
+# Stands in for the entity pk in cached responses.
+PK_PLACEHOLDER = uuid.UUID(int=0)
 
 app = Flask(__name__)
 app.config.from_object(__name__)
 
-db = shelve.open(os.path.join(
+db = WriteBehindStore(os.path.join(
     app.root_path, app.config['SHELVE_DB']),
-    protocol=HIGHEST_PROTOCOL, writeback=True)
+    durability=app.config['SHELVE_DURABILITY'],
+    max_pending=app.config['SHELVE_MAX_PENDING'],
+    max_delay=app.config['SHELVE_MAX_DELAY'],
+    cold=app.config['COLD_STORE_DB'] and ColdStore(os.path.join(
+        app.root_path, app.config['COLD_STORE_DB'])),
+    protocol=HIGHEST_PROTOCOL)
+
+log = TransitionLog(os.path.join(
+    app.root_path, app.config['TRANSITION_LOG']))
+
+codegen.install_all(os.path.join(
+    app.root_path, app.config['DISPATCH_CACHE']))
 
 app = Flask(__name__)
 
+payload_cache = {}
+routes_cache = {}
+
 
 def init(name, pk):
     key = name + ':' + str(pk)
     obj = registry[name]()
-    db.setdefault(key, default=dict(state=obj.state))
-    obj.state = obj.fsm.states(db[key]['state'])
+    now = time.time()
+    record = db.setdefault(key, default=dict(state=obj.state, accessed=now))
+    obj.state = obj.fsm.states(record['state'])
+    if now - record.get('accessed', 0) >= ACCESS_RESOLUTION:
+        db.touch(key, now)
     return obj
 
 
 def update(name, pk, state):
     key = name + ':' + str(pk)
-    db[key]['state'] = state
+    db[key] = dict(state=state, accessed=time.time())
+
+
+def disposable(key, record):
+    """
+    Check if a stored entity is in its default or a terminal state.
+    """
+    name = key.split(':', 1)[0]
+    if name not in registry:
+        return False
+    fsm = registry[name]().fsm
+    state = fsm.states(record['state'])
+    return state == fsm.states.default() or fsm.is_terminal(state)
+
+
+def sweep():
+    """
+    Periodically evict expired entities and move idle ones to cold storage.
+    """
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        evicted, moved = db.expire(ENTITY_TTL, disposable, idle=COLD_AFTER)
+        app.logger.debug("evicted %d and moved %d idle entities", evicted, moved)
+
+
+def payload(endpoint, name, fsm, state, pk):
+    """
+    Return the JSON response for an entity of a machine in the given state.
+
+    The body only depends on pk through its URLs, so it is serialized once per
+    (machine, state) with a placeholder pk and the real pk is substituted in.
+    """
+    key = (request.script_root, endpoint, name, state)
+    template = payload_cache.get(key)
+    if template is None:
+        events = []
+        for state0, _, event in fsm.edges:
+            if state0 == state:
+                events.append(dict(
+                    name=event.name,
+                    url=url_for('api_state_update', name=name, pk=PK_PLACEHOLDER, event=event.name)
+                    ))
+        data = dict(
+            state=state.name,
+            image_url=url_for('api_state_png', name=name, pk=PK_PLACEHOLDER),
+            events=events)
+        if endpoint == 'api_state_update':
+            data['url'] = url_for('api_state', name=name, pk=PK_PLACEHOLDER)
+        template = payload_cache[key] = json.dumps(data, sort_keys=True)
+    body = template.replace(str(PK_PLACEHOLDER), str(pk))
+    return app.response_class(body, mimetype='application/json')
 
 
 def render(fsm, state):
@@ -108,7 +192,8 @@ def get(name, pk):
 @app.route('/')
 def post(name='connections'):
     uuid4 = uuid.uuid4()
-    init(name, uuid4)
+    obj = init(name, uuid4)
+    log.append(name, uuid4, obj.state, 0, obj.state)
     return redirect(url_for('get', name=name, pk=uuid4))
 
 
@@ -128,22 +213,12 @@ def api_state_png(name, pk):
 @app.route('/api/<name>/<uuid:pk>/<event>', methods=['PUT'])
 def api_state_update(name, pk, event):
     obj = init(name, pk)
+    state0 = obj.state
     if obj.fsm.move(obj, obj.fsm.events[event]):
         state1 = obj.state
         update(name, pk, state1)
-        events = []
-        for edge in obj.fsm.edges:
-            state0, _, event = edge
-            if state0 == state1:
-                events.append(dict(
-                    name=event.name,
-                    url=url_for('api_state_update', name=name, pk=pk, event=event.name)
-                    ))
-        return jsonify(dict(
-            state=state1.name,
-            url=url_for('api_state', name=name, pk=pk),
-            image_url=url_for('api_state_png', name=name, pk=pk),
-            events=events))
+        log.append(name, pk, state0, obj.fsm.events[event], state1)
+        return payload('api_state_update', name, obj.fsm, state1, pk)
     resp = jsonify({})
     resp.status_code = 409
     return resp
@@ -152,36 +227,29 @@ def api_state_update(name, pk, event):
 @app.route('/api/<name>/<uuid:pk>')
 def api_state(name, pk):
     obj = init(name, pk)
-    events = []
-    for edge in obj.fsm.edges:
-        state0, _, event = edge
-        if state0 == obj.state:
-            events.append(dict(
-                name=event.name,
-                url=url_for('api_state_update', name=name, pk=pk, event=event.name)
-                ))
-    return jsonify(dict(
-        state=obj.state.name,
-        image_url=url_for('api_state_png', name=name, pk=pk),
-        events=events))
+    return payload('api_state', name, obj.fsm, obj.state, pk)
 
 
 @app.route("/api")
 def api_root():
-    routes = []
-    for rule in app.url_map.iter_rules():
-        options = {}
-        for arg in rule.arguments:
-            options[arg] = "[{0}]".format(arg)
-        url = urllib.parse.unquote(url_for(rule.endpoint, **options))
-        routes.append(dict(
-            endpoint=rule.endpoint,
-            methods=sorted(list(rule.methods)),
-            url=url))
-    return jsonify(sorted(routes, key=itemgetter('url')))
+    key = request.script_root
+    if key not in routes_cache:
+        routes = []
+        for rule in app.url_map.iter_rules():
+            options = {}
+            for arg in rule.arguments:
+                options[arg] = "[{0}]".format(arg)
+            url = urllib.parse.unquote(url_for(rule.endpoint, **options))
+            routes.append(dict(
+                endpoint=rule.endpoint,
+                methods=sorted(list(rule.methods)),
+                url=url))
+        routes_cache[key] = json.dumps(sorted(routes, key=itemgetter('url')))
+    return app.response_class(routes_cache[key], mimetype='application/json')
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
-    with closing(db):
+    threading.Thread(target=sweep, daemon=True).start()
+    with closing(db), closing(log):
         app.run(debug=True, threaded=True)
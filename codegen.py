@@ -0,0 +1,156 @@
+"""
+Generate specialized move functions for FSM subclasses.
+
+The generated module replaces the generic dict lookups and validity checks
+of FSM.move with a jump table indexed by state and event values. Modules are
+cached on disk and only regenerated when a machine's transitions change.
+
+    python codegen.py generated
+"""
+import hashlib
+import importlib.util
+import os
+import sys
+
+import machines
+from registry import registry
+
+
+TEMPLATE = '''\
+# Generated by codegen.py from {module}.{name}. Do not edit.
+# fingerprint: {fingerprint}
+from fsm import FSM
+from {states_module} import {states_name} as _S
+from {events_module} import {events_name} as _E
+
+{tables}
+
+NEXT = (
+{rows}
+)
+
+# Filled in by codegen.install with the data attached to each transition.
+DATA = {{}}
+
+
+def move(self, obj, event, callback=None):
+    # Anything but a member of the machine's own events takes the generic
+    # path, so foreign events and plain ints behave exactly as in FSM.move.
+    if type(event) is not _E:
+        return FSM.move(self, obj, event, callback)
+    state0 = obj.state
+    try:
+        state1 = NEXT[state0][event]
+    except (IndexError, TypeError):
+        return False
+    if state1 is None:
+        return False
+    obj.state = state1
+    if callback is not None:
+        callback(obj, DATA.get((state0, event)))
+    return True
+'''
+
+
+def fingerprint(fsm):
+    """
+    Return a hash of the states, events and transitions of a FSM.
+
+    The generator template is part of the hash, so cached modules are
+    regenerated whenever the generated code changes.
+    """
+    edges = sorted((int(s0), int(e), int(s1)) for s0, s1, e in fsm.edges)
+    text = repr((fsm.states.__qualname__, [(s.name, int(s)) for s in fsm.states],
+                 fsm.events.__qualname__, [(e.name, int(e)) for e in fsm.events],
+                 edges, TEMPLATE))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def generate(fsm):
+    """
+    Return the source of a module with a specialized move for fsm.
+
+    States and events must be integer enums bound at module level, as every
+    machine in this package defines them.
+    """
+    cls = type(fsm)
+    nevents = max(int(e) for e in fsm.events) + 1
+    tables = []
+    rows = []
+    for value in range(max(int(s) for s in fsm.states) + 1):
+        try:
+            state0 = fsm.states(value)
+        except ValueError:
+            rows.append('    None,')
+            continue
+        targets = ['None'] * nevents
+        for event in fsm.events:
+            state1 = fsm.peek(state0, event)
+            if state1 is not None:
+                targets[int(event)] = '_S(%d)' % int(state1)
+        table = '_STATE%d' % value
+        tables.append('# %s\n%s = (%s)' % (state0.name, table, ', '.join(targets)))
+        rows.append('    %s,' % table)
+    return TEMPLATE.format(
+        module=cls.__module__,
+        name=cls.__qualname__,
+        fingerprint=fingerprint(fsm),
+        states_module=fsm.states.__module__,
+        states_name=fsm.states.__qualname__,
+        events_module=fsm.events.__module__,
+        events_name=fsm.events.__qualname__,
+        tables='\n'.join(tables),
+        rows='\n'.join(rows))
+
+
+def load(fsm, cache_dir):
+    """
+    Import the specialized module for fsm, generating it if needed.
+    """
+    cls = type(fsm)
+    name = '_fsm_' + (cls.__module__ + '_' + cls.__qualname__).replace('.', '_')
+    path = os.path.join(cache_dir, name + '.py')
+    expected = '# fingerprint: ' + fingerprint(fsm)
+    try:
+        with open(path) as f:
+            current = f.read().splitlines()[1]
+    except (OSError, IndexError):
+        current = None
+    if current != expected:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            f.write(generate(fsm))
+        os.replace(path + '.tmp', path)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def install(fsm, cache_dir):
+    """
+    Replace move on the class of fsm with its specialized version.
+
+    Every instance of the class must build the same transitions in its
+    constructor, since they all share the generated table.
+    """
+    module = load(fsm, cache_dir)
+    for (state0, event), transition in fsm.transitions.items():
+        if transition['data'] is not None:
+            module.DATA[(state0, event)] = transition['data']
+    type(fsm).move = module.move
+    return module
+
+
+def install_all(cache_dir):
+    """
+    Install specialized moves for every registered machine.
+    """
+    for cls in registry.values():
+        install(cls().fsm, cache_dir)
+
+
+if __name__ == '__main__':
+    cache_dir = sys.argv[1] if len(sys.argv) > 1 else 'generated'
+    for cls in registry.values():
+        print(load(cls().fsm, cache_dir).__file__)
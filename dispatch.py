@@ -0,0 +1,102 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class Dispatcher(object):
+    """
+    Run FSM callbacks on a bounded thread pool instead of inline.
+
+    Callbacks submitted under the same key (e.g. 'documents:<pk>') run one at
+    a time in submission order, while callbacks for different keys run
+    concurrently. At most max_pending callbacks may be queued or running;
+    once that limit is reached, submit blocks until a slot frees up.
+
+    A callback that raises does not stop the callbacks queued behind it. The
+    failure is passed to the error handler, which logs it by default.
+    """
+
+    def __init__(self, max_workers=4, max_pending=1024, on_error=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.on_error = on_error or self.log_error
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._closed = False
+
+    def callback(self, key, func):
+        """
+        Wrap func so it can be passed as the callback argument of FSM.move.
+
+        The wrapped callback returns as soon as the call has been queued. It
+        queues a shallow copy of the object, so func sees the state right
+        after the transition even if the object moves again before func runs.
+        """
+        def dispatch(obj, data):
+            self.submit(key, func, copy.copy(obj), data)
+        return dispatch
+
+    def submit(self, key, func, obj, data, timeout=None):
+        """
+        Queue func(obj, data) to run after earlier callbacks for key.
+
+        Blocks while the dispatcher is full. Returns False if no slot became
+        available within timeout, otherwise True. Raises RuntimeError once
+        the dispatcher has been closed.
+        """
+        if self._closed:
+            raise RuntimeError("cannot submit callbacks after close")
+        if not self.slots.acquire(timeout=timeout):
+            return False
+        with self._lock:
+            if self._closed:
+                self.slots.release()
+                raise RuntimeError("cannot submit callbacks after close")
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append((func, obj, data))
+                return True
+            self._queues[key] = deque([(func, obj, data)])
+            # Scheduled under the lock so close() cannot shut the executor
+            # down between creating the queue and starting its drain.
+            self.executor.submit(self._drain, key)
+        return True
+
+    def close(self, wait=True):
+        """
+        Stop accepting callbacks and optionally wait for queued ones to finish.
+        """
+        with self._lock:
+            self._closed = True
+        self.executor.shutdown(wait=wait)
+
+    def log_error(self, key, obj, data, exc):
+        logger.error("callback for %s failed", key, exc_info=exc)
+
+    def _drain(self, key):
+        while True:
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                func, obj, data = queue[0]
+            try:
+                func(obj, data)
+            except Exception as exc:
+                with self._lock:
+                    self.failures += 1
+                try:
+                    self.on_error(key, obj, data, exc)
+                except Exception:
+                    logger.exception("error handler for %s failed", key)
+            finally:
+                with self._lock:
+                    queue.popleft()
+                self.slots.release()
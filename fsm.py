@@ -65,6 +65,12 @@ class FSM(object):
             return False
         return (state, event) in self.transitions
 
+    def is_terminal(self, state):
+        """
+        Verify if state has no outgoing transitions.
+        """
+        return not any(state0 == state for state0, _ in self.transitions)
+
     def peek(self, state, event):
         """
         Find the next valid state.
@@ -84,7 +90,8 @@ class FSM(object):
         The optional callback must take two parameters. The first parameter is
         the updated object. The second parameter is the arbitrary data attached
         when defining a transition. The callback will only be called after the
-        object state has been saved.
+        object state has been saved. To run the callback without blocking the
+        move, wrap it with dispatch.Dispatcher.callback.
 
         Returns boolean indicating whether the move was successful.
         """
@@ -0,0 +1,292 @@
+"""
+Fuzz every registered machine against each dispatch and persistence path.
+
+For each machine and seed, a long random event sequence is run through the
+generic FSM.move, the generated move from codegen and a round trip through
+WriteBehindStore and ColdStore after every event. All three must produce
+the same result and state at every step. Events per second are reported
+for each engine, and TTL expiry and cold tiering are checked once per
+machine. The pattern recognizer is checked against re for each seed.
+
+    python fuzz.py --length 100000 --seeds 5
+"""
+import argparse
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+import codegen
+from fsm import FSM
+import machines
+from recognizer import Recognizer
+from registry import registry
+from store import ColdStore, Durability, WriteBehindStore
+
+
+def foreign_events(name):
+    """
+    Return events a machine does not define: members of other machines'
+    event enums, and plain ints inside and outside its event range.
+    """
+    own = registry[name]().fsm.events
+    result = []
+    for cls in registry.values():
+        events = cls().fsm.events
+        if events is not own:
+            result.extend(events)
+    top = max(int(e) for e in own)
+    result.extend([-top, -1, 0, 1, top, top + 1, 2 ** 31])
+    return result
+
+
+def attempt(move, fsm, obj, event):
+    """
+    Call move and return its result, or the type of exception it raised.
+    """
+    try:
+        return move(fsm, obj, event)
+    except Exception as exc:
+        return type(exc)
+
+
+def events(name, length, seed, valid=0.8, foreign=0.05):
+    """
+    Return a random event sequence for a machine.
+
+    With probability valid each event is one the machine accepts in its
+    current state, otherwise it is any event, so invalid moves are exercised
+    too without leaving the machine stuck in its first few states. With
+    probability foreign the event is instead one the machine does not define
+    at all, since specialized engines must reject those exactly as FSM.move
+    does.
+    """
+    rng = random.Random(seed)
+    obj = registry[name]()
+    fsm = obj.fsm
+    everything = list(fsm.events)
+    strangers = foreign_events(name)
+    outgoing = {}
+    for state0, event in fsm.transitions:
+        outgoing.setdefault(state0, []).append(event)
+    result = []
+    for _ in range(length):
+        choices = outgoing.get(obj.state)
+        roll = rng.random()
+        if roll < foreign:
+            event = rng.choice(strangers)
+        elif choices and roll < foreign + valid:
+            event = rng.choice(choices)
+        else:
+            event = rng.choice(everything)
+        attempt(FSM.move, fsm, obj, event)
+        result.append(event)
+    return result
+
+
+def generic(name, sequence, workdir):
+    obj = registry[name]()
+    for event in sequence:
+        yield attempt(FSM.move, obj.fsm, obj, event), obj.state
+
+
+def generated(name, sequence, workdir):
+    obj = registry[name]()
+    move = codegen.load(obj.fsm, os.path.join(workdir, 'generated')).move
+    for event in sequence:
+        yield attempt(move, obj.fsm, obj, event), obj.state
+
+
+def persisted(name, sequence, workdir, every=97):
+    """
+    Reload the state from the store before every move and save it after.
+
+    Every so often the store is synced, the entity is moved to cold storage,
+    or the store is closed and reopened, so all tiers are exercised.
+    """
+    def open_store():
+        return WriteBehindStore(os.path.join(workdir, name),
+                                durability=Durability.Lazy,
+                                cold=ColdStore(os.path.join(workdir, name + '-cold')))
+
+    key = name + ':fuzz'
+    db = open_store()
+    obj = registry[name]()
+    db[key] = dict(state=obj.state, accessed=0)
+    try:
+        for i, event in enumerate(sequence):
+            obj = registry[name]()
+            obj.state = obj.fsm.states(db[key]['state'])
+            moved = attempt(FSM.move, obj.fsm, obj, event)
+            db[key] = dict(state=obj.state, accessed=i)
+            if i % every == 0:
+                db.sync()
+            elif i % every == 1:
+                db.expire(float('inf'), lambda k, v: False, idle=0, now=i)
+            elif i % every == 2:
+                db.close()
+                db = open_store()
+            yield moved, obj.state
+    finally:
+        db.close()
+
+
+def disposable(key, value):
+    """
+    Check if an entity is in its default or a terminal state, as the app does.
+    """
+    fsm = registry[key.split(':', 1)[0]]().fsm
+    state = fsm.states(value['state'])
+    return state == fsm.states.default() or fsm.is_terminal(state)
+
+
+def check_expiry(name, workdir, ttl=86400, idle=3600):
+    """
+    Return a description of the first expiry bug for a machine, or None.
+
+    A disposable entity must survive until its TTL and then be deleted from
+    both tiers, while any other entity must move to the cold store once idle
+    and still be readable after every sweep. Reading it back must keep the
+    cold copy until the store is synced.
+    """
+    fsm = registry[name]().fsm
+    kept = [s for s in fsm.states if not disposable(name + ':', dict(state=s))]
+    db = WriteBehindStore(os.path.join(workdir, name), durability=Durability.Lazy,
+                          cold=ColdStore(os.path.join(workdir, name + '-cold')))
+    try:
+        db[name + ':disposable'] = dict(state=fsm.states.default(), accessed=0)
+        if kept:
+            db[name + ':kept'] = dict(state=kept[0], accessed=0)
+        db.expire(ttl, disposable, idle=idle, now=idle * 2)
+        if name + ':disposable' not in db:
+            return 'disposable entity deleted before its TTL'
+        if kept and name + ':kept' in db.keys():
+            return 'idle entity not moved to the cold store'
+        db.expire(ttl, disposable, idle=idle, now=ttl * 10)
+        if name + ':disposable' in db:
+            return 'disposable entity still stored after its TTL'
+        if kept and db.get(name + ':kept') != dict(state=kept[0], accessed=0):
+            return 'idle entity lost from the cold store'
+        if kept and name + ':kept' not in db.cold:
+            return 'cold copy removed before the entity was committed'
+        db.sync()
+        if kept and name + ':kept' in db.cold:
+            return 'cold copy kept after the entity was committed'
+    finally:
+        db.close()
+    return None
+
+
+# Patterns whose syntax means the same to Recognizer and re. None starts
+# with '.*', so many inputs reach Reject part way through.
+PATTERNS = ['AB', 'A*BA*', 'A+', 'A.B*', 'B?A.', 'A\\.B']
+
+
+def check_recognizer(seed, count=2000, alphabet=b'AB.C'):
+    """
+    Return a description of the first recognizer bug for a seed, or None.
+
+    Random inputs are fed to a scanner in random chunks, including empty ones
+    and more after no pattern can match, and the result must agree with
+    re.fullmatch for every pattern. Moving out of Reject with the FSM must
+    stay in Reject.
+    """
+    rng = random.Random(seed)
+    recognizer = Recognizer(PATTERNS)
+    compiled = [re.compile(p.encode('latin-1'), re.DOTALL) for p in PATTERNS]
+    for _ in range(count):
+        data = bytes(rng.choice(alphabet) for _ in range(rng.randrange(12)))
+        scanner = recognizer.scanner()
+        i = 0
+        while i < len(data):
+            j = rng.randint(i, len(data))
+            try:
+                scanner.feed(data[i:j])
+            except ValueError as exc:
+                return 'feeding %r in chunks raised %s' % (data, exc)
+            i = j
+        expected = [p for p, r in zip(PATTERNS, compiled) if r.fullmatch(data)]
+        if scanner.finish() != expected:
+            return 'matched %r as %r, expected %r' % (data, scanner.finish(), expected)
+    fsm = recognizer.fsm
+    scanner = recognizer.scanner()
+    scanner.state = fsm.states.Reject
+    for event in fsm.events:
+        if not fsm.move(scanner, event) or scanner.state != fsm.states.Reject:
+            return 'move from Reject on %s left Reject' % event.name
+    return None
+
+
+ENGINES = (('generic', generic), ('generated', generated), ('persisted', persisted))
+
+
+def check(name, length, seed, workdir):
+    """
+    Return (rates, mismatch) for one machine and seed.
+
+    rates maps each engine to events per second. mismatch is None, or the
+    (engine, step, expected, actual) of the first divergence from generic.
+    """
+    sequence = events(name, length, seed)
+    rates = {}
+    traces = {}
+    for engine, run in ENGINES:
+        start = time.perf_counter()
+        traces[engine] = list(run(name, sequence, workdir))
+        rates[engine] = length / (time.perf_counter() - start)
+    for engine, _ in ENGINES[1:]:
+        for step, (expected, actual) in enumerate(zip(traces['generic'], traces[engine])):
+            if expected != actual:
+                return rates, (engine, step, expected, actual)
+    return rates, None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--length', type=int, default=10000,
+                        help='events per sequence')
+    parser.add_argument('--seeds', type=int, default=3,
+                        help='sequences per machine')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='first seed')
+    parser.add_argument('--machines', default=','.join(sorted(registry)),
+                        help='comma-separated machine names')
+    args = parser.parse_args(argv)
+
+    failures = 0
+    print('%-12s %6s %12s %12s %12s' % (('machine', 'seed') + tuple(e for e, _ in ENGINES)))
+    for name in args.machines.split(','):
+        for seed in range(args.seed, args.seed + args.seeds):
+            workdir = tempfile.mkdtemp(prefix='fuzz-')
+            try:
+                rates, mismatch = check(name, args.length, seed, workdir)
+            finally:
+                shutil.rmtree(workdir)
+            print('%-12s %6d %12.0f %12.0f %12.0f' % (
+                (name, seed) + tuple(rates[e] for e, _ in ENGINES)))
+            if mismatch is not None:
+                failures += 1
+                engine, step, expected, actual = mismatch
+                print('  %s diverged at step %d: expected %r, got %r' % (
+                    engine, step, expected, actual))
+        workdir = tempfile.mkdtemp(prefix='fuzz-')
+        try:
+            problem = check_expiry(name, workdir)
+        finally:
+            shutil.rmtree(workdir)
+        if problem is not None:
+            failures += 1
+            print('  expiry: %s' % problem)
+    for seed in range(args.seed, args.seed + args.seeds):
+        problem = check_recognizer(seed)
+        if problem is not None:
+            failures += 1
+            print('recognizer seed %d: %s' % (seed, problem))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
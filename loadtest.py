@@ -0,0 +1,232 @@
+"""
+Generate local traffic against a running app and report latency and throughput.
+
+Each simulated client creates entities, moves them along valid transitions
+of their machine and fetches their state diagrams, in proportions set by
+--mix. Running at several concurrency levels prints a saturation curve.
+
+    python loadtest.py --url http://127.0.0.1:5000 --concurrency 1,4,16,64
+"""
+import argparse
+import asyncio
+from bisect import bisect
+from itertools import accumulate
+import math
+import random
+import time
+from urllib.parse import urlsplit
+
+import machines
+from registry import registry
+
+
+ENDPOINTS = ('post', 'api_state_update', 'api_state_png')
+
+
+class Stats(object):
+    """
+    Latencies and error counts for each endpoint during one run.
+    """
+
+    def __init__(self):
+        self.latencies = dict((e, []) for e in ENDPOINTS)
+        self.errors = dict((e, 0) for e in ENDPOINTS)
+        self.started = time.monotonic()
+        self.finished = None
+
+    def record(self, endpoint, latency, ok):
+        self.latencies[endpoint].append(latency)
+        if not ok:
+            self.errors[endpoint] += 1
+
+    def summary(self):
+        """
+        Return a row of (endpoint, requests, req/s, error rate, p50, p99, p999).
+        """
+        elapsed = (self.finished or time.monotonic()) - self.started
+        rows = []
+        for endpoint in ENDPOINTS:
+            latencies = sorted(self.latencies[endpoint])
+            count = len(latencies)
+            rows.append((endpoint, count, count / elapsed,
+                         self.errors[endpoint] / count if count else 0.0,
+                         percentile(latencies, 0.5),
+                         percentile(latencies, 0.99),
+                         percentile(latencies, 0.999)))
+        return rows
+
+
+def percentile(values, q):
+    """
+    Return the q-th quantile of sorted values, or NaN if there are none.
+    """
+    if not values:
+        return float('nan')
+    return values[max(0, int(math.ceil(q * len(values))) - 1)]
+
+
+def parse_mix(text):
+    weights = dict((e, 0.0) for e in ENDPOINTS)
+    for item in text.split(','):
+        endpoint, weight = item.split('=')
+        if endpoint not in weights:
+            raise ValueError("unknown endpoint in mix: %r" % endpoint)
+        weights[endpoint] = float(weight)
+    return weights
+
+
+async def request(host, port, method, path, timeout):
+    """
+    Send one HTTP request on a fresh connection and return (status, headers).
+
+    Raises asyncio.TimeoutError if the whole exchange takes longer than
+    timeout seconds.
+    """
+    return await asyncio.wait_for(_exchange(host, port, method, path), timeout)
+
+
+async def _exchange(host, port, method, path):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(('%s %s HTTP/1.1\r\n'
+                      'Host: %s:%d\r\n'
+                      'Connection: close\r\n'
+                      'Content-Length: 0\r\n\r\n' % (method, path, host, port)).encode('latin-1'))
+        data = await reader.read()
+    finally:
+        writer.close()
+    head = data.split(b'\r\n\r\n', 1)[0].decode('latin-1').split('\r\n')
+    status = int(head[0].split()[1])
+    headers = dict(line.split(': ', 1) for line in head[1:] if ': ' in line)
+    return status, headers
+
+
+class Client(object):
+    """
+    A simulated user that keeps a local copy of every entity it created.
+
+    The local copies are moved with the same FSM as the server, so every
+    transition the client sends is valid for the entity's current state.
+    Entities that reach a terminal state, or whose update fails, are
+    forgotten.
+    """
+
+    def __init__(self, host, port, names, weights, stats, timeout):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.names = names
+        self.weights = weights
+        self.stats = stats
+        self.entities = []
+
+    async def timed(self, endpoint, method, path):
+        start = time.monotonic()
+        try:
+            status, headers = await request(self.host, self.port, method, path, self.timeout)
+        except (OSError, ValueError, IndexError, asyncio.TimeoutError):
+            self.stats.record(endpoint, time.monotonic() - start, False)
+            return None, {}
+        self.stats.record(endpoint, time.monotonic() - start, status < 400)
+        return status, headers
+
+    async def create(self):
+        name = random.choice(self.names)
+        status, headers = await self.timed('post', 'GET', '/machines/%s/' % name)
+        location = headers.get('Location')
+        if status == 302 and location:
+            obj = registry[name]()
+            if obj.fsm.is_terminal(obj.state):
+                return
+            self.entities.append((name, urlsplit(location).path.rsplit('/', 1)[1], obj))
+
+    async def move(self):
+        entity = random.choice(self.entities)
+        name, pk, obj = entity
+        event = random.choice([e for (s, e) in obj.fsm.transitions if s == obj.state])
+        status, _ = await self.timed('api_state_update', 'PUT',
+                                     '/api/%s/%s/%s' % (name, pk, event.name))
+        if status != 200:
+            # The server may or may not have applied the move, so the local
+            # copy can no longer be trusted to pick valid events.
+            self.entities.remove(entity)
+            return
+        obj.fsm.move(obj, event)
+        if obj.fsm.is_terminal(obj.state):
+            self.entities.remove(entity)
+
+    async def fetch_png(self):
+        name, pk, _ = random.choice(self.entities)
+        await self.timed('api_state_png', 'GET', '/api/%s/%s.png' % (name, pk))
+
+    async def run(self, deadline):
+        actions = dict(post=self.create, api_state_update=self.move, api_state_png=self.fetch_png)
+        cumulative = list(accumulate(self.weights[e] for e in ENDPOINTS))
+        while time.monotonic() < deadline:
+            if not self.entities:
+                await self.create()
+                continue
+            endpoint = ENDPOINTS[bisect(cumulative, random.random() * cumulative[-1])]
+            await actions[endpoint]()
+
+
+async def run(url, concurrency, duration, names, weights, timeout):
+    """
+    Run concurrency clients against url for duration seconds and return Stats.
+    """
+    parts = urlsplit(url)
+    stats = Stats()
+    deadline = time.monotonic() + duration
+    clients = [Client(parts.hostname, parts.port or 80, names, weights, stats, timeout)
+               for _ in range(concurrency)]
+    await asyncio.gather(*(c.run(deadline) for c in clients))
+    stats.finished = time.monotonic()
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--concurrency', default='1,2,4,8,16,32,64',
+                        help='comma-separated client counts, one run each')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds per run')
+    parser.add_argument('--timeout', type=float, default=5.0,
+                        help='seconds before a request counts as an error')
+    parser.add_argument('--mix', default='post=1,api_state_update=8,api_state_png=1',
+                        help='relative weight of each endpoint')
+    parser.add_argument('--machines', default=','.join(sorted(registry)),
+                        help='comma-separated machine names to create')
+    args = parser.parse_args(argv)
+
+    weights = parse_mix(args.mix)
+    names = args.machines.split(',')
+    loop = asyncio.new_event_loop()
+    curve = []
+    try:
+        for concurrency in [int(c) for c in args.concurrency.split(',')]:
+            stats = loop.run_until_complete(run(
+                args.url, concurrency, args.duration, names, weights, args.timeout))
+            print('concurrency %d' % concurrency)
+            print('  %-18s %8s %9s %7s %9s %9s %9s' % (
+                'endpoint', 'requests', 'req/s', 'errors', 'p50 ms', 'p99 ms', 'p999 ms'))
+            total = errors = 0
+            for endpoint, count, rate, error_rate, p50, p99, p999 in stats.summary():
+                print('  %-18s %8d %9.1f %6.2f%% %9.2f %9.2f %9.2f' % (
+                    endpoint, count, rate, error_rate * 100, p50 * 1000, p99 * 1000, p999 * 1000))
+                total += count
+                errors += stats.errors[endpoint]
+            latencies = sorted(sum(stats.latencies.values(), []))
+            curve.append((concurrency, total / (stats.finished - stats.started),
+                          errors / total if total else 0.0, percentile(latencies, 0.99)))
+    finally:
+        loop.close()
+
+    print('saturation curve')
+    print('  %11s %9s %7s %9s' % ('concurrency', 'req/s', 'errors', 'p99 ms'))
+    for concurrency, rate, error_rate, p99 in curve:
+        print('  %11d %9.1f %6.2f%% %9.2f' % (concurrency, rate, error_rate * 100, p99 * 1000))
+
+
+if __name__ == '__main__':
+    main()
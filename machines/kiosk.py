@@ -0,0 +1,40 @@
+from fsm import FSM
+from machines.button import ButtonFSM
+from machines.turnstile import TurnstileFSM
+from registry import register
+from statechart import flatten, Parallel, Region
+
+
+KioskState, KioskEvent, _transitions = flatten(
+    Parallel(Region(TurnstileFSM()), Region(ButtonFSM())), 'Kiosk', __name__)
+
+
+class KioskFSM(FSM):
+    """
+    A FSM implementation for a turnstile with a call button.
+
+    The turnstile and the button are independent regions of one statechart,
+    compiled once at import time into the flat KioskState and KioskEvent
+    enumerations. See statechart module for details.
+    """
+
+    def __init__(self):
+        super(KioskFSM, self).__init__(KioskState, KioskEvent)
+        self.transitions = dict(_transitions)
+
+
+@register
+class Kiosk(object):
+    __clsid__ = 'kiosks'
+
+    def __init__(self):
+        self.fsm = KioskFSM()
+        self._state = self.fsm.states.default()
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, value):
+        self._state = value
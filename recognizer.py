@@ -0,0 +1,224 @@
+"""
+Match many simple patterns against a byte stream in a single pass.
+
+Patterns use the same small language as the regex demo machine: literal
+characters, '.' for any byte, the postfix operators '*', '+' and '?', and
+backslash to escape an operator. A pattern accepts if it matches the whole
+input, as PatternFSM does for [A*BA*].
+
+    python recognizer.py input.dat 'A*BA*' 'A+' '.*B'
+"""
+from collections import deque
+import mmap
+import sys
+
+from enums import UniqueIntEnum
+from fsm import FSM
+from statechart import CompositeState
+
+
+def parse(pattern):
+    """
+    Return a pattern as a list of (byte, repeat, optional) items.
+
+    A byte of None matches anything, repeat is True for a starred item and
+    optional is True for an item followed by '?'.
+    """
+    data = pattern.encode('latin-1') if isinstance(pattern, str) else pattern
+    items = []
+    i = 0
+    while i < len(data):
+        c = data[i]
+        if c == ord('\\'):
+            i += 1
+            if i == len(data):
+                raise ValueError("trailing backslash in %r" % pattern)
+            c = data[i]
+        elif c == ord('.'):
+            c = None
+        elif c in b'*+?':
+            raise ValueError("nothing to repeat at %d in %r" % (i, pattern))
+        op = data[i + 1] if i + 1 < len(data) else None
+        if op == ord('*'):
+            items.append((c, True, False))
+            i += 2
+        elif op == ord('+'):
+            items.append((c, False, False))
+            items.append((c, True, False))
+            i += 2
+        elif op == ord('?'):
+            items.append((c, False, True))
+            i += 2
+        else:
+            items.append((c, False, False))
+            i += 1
+    return items
+
+
+class Recognizer(object):
+    """
+    A merged DFA for a set of patterns, built as a FSM.
+
+    Each state of the FSM is a set of positions in every pattern at once, so
+    a single scan decides all patterns. Bytes are grouped into events: one
+    per byte that appears literally in some pattern and one for all others.
+    The start state is the default state and the Reject state is where no
+    pattern can match anymore, at which point scanning stops early.
+
+    Raises ValueError if there are no patterns or if the merged DFA needs
+    more than max_states states.
+    """
+
+    def __init__(self, patterns, max_states=10000):
+        self.patterns = list(patterns)
+        if not self.patterns:
+            raise ValueError("at least one pattern is required")
+        self.items = [parse(p) for p in self.patterns]
+        literals = sorted(set(c for items in self.items for c, _, _ in items if c is not None))
+
+        classes = bytearray(256)
+        for k, c in enumerate(literals, 1):
+            classes[c] = k
+        self.classes = bytes(classes)
+        members = [None] + literals
+
+        start = self._closure((p, 0) for p in range(len(self.items)))
+        dead = frozenset()
+        index = {start: 1, dead: 2}
+        order = [start, dead]
+        edges = []
+        # Reject is queued too, so it loops back to itself on every event.
+        queue = deque([start, dead])
+        while queue:
+            config = queue.popleft()
+            for k, byte in enumerate(members):
+                target = self._step(config, byte)
+                if target not in index:
+                    if len(order) == max_states:
+                        raise ValueError("patterns need more than %d states" % max_states)
+                    index[target] = len(order) + 1
+                    order.append(target)
+                    queue.append(target)
+                edges.append((index[config], k, index[target]))
+
+        names = ['Start', 'Reject'] + ['S%d' % i for i in range(3, len(order) + 1)]
+        states = CompositeState('RecognizerState', list(zip(names, range(1, len(order) + 1))),
+                                module=__name__)
+        events = UniqueIntEnum('RecognizerEvent',
+                               [('Other', 1)] + [(self._event_name(c), k + 1)
+                                                 for k, c in enumerate(literals, 1)],
+                               module=__name__)
+        self.fsm = FSM(states, events)
+        for state0, k, state1 in edges:
+            self.fsm.add_transition(states(state0), events(k + 1), states(state1))
+
+        self.accepts = [None] + [
+            frozenset(p for p, i in config if i == len(self.items[p])) for config in order]
+        nclasses = len(members)
+        self.table = [0] * ((len(order) + 1) * nclasses)
+        for (state0, event), transition in self.fsm.transitions.items():
+            self.table[state0 * nclasses + event - 1] = int(transition['state'])
+        self.nclasses = nclasses
+
+    def scanner(self):
+        return Scanner(self)
+
+    def match(self, data):
+        """
+        Return the patterns that match the whole of data.
+        """
+        scanner = self.scanner()
+        scanner.feed(data)
+        return scanner.finish()
+
+    def match_file(self, filename, chunk_size=1 << 20):
+        """
+        Return the patterns that match the whole of a file.
+
+        The file is memory-mapped and fed in chunks, so it is never read into
+        memory at once.
+        """
+        scanner = self.scanner()
+        with open(filename, 'rb') as f:
+            try:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                return scanner.finish()
+            with m:
+                for offset in range(0, len(m), chunk_size):
+                    if not scanner.feed(m[offset:offset + chunk_size]):
+                        break
+        return scanner.finish()
+
+    def _closure(self, positions):
+        closure = set()
+        stack = list(positions)
+        while stack:
+            p, i = stack.pop()
+            if (p, i) in closure:
+                continue
+            closure.add((p, i))
+            items = self.items[p]
+            if i < len(items) and (items[i][1] or items[i][2]):
+                stack.append((p, i + 1))
+        return frozenset(closure)
+
+    def _step(self, config, byte):
+        positions = []
+        for p, i in config:
+            items = self.items[p]
+            if i == len(items):
+                continue
+            c, repeat, _ = items[i]
+            if c is None or c == byte:
+                positions.append((p, i) if repeat else (p, i + 1))
+        return self._closure(positions)
+
+    @staticmethod
+    def _event_name(c):
+        ch = chr(c)
+        return ch if ch.isalnum() else 'x%02X' % c
+
+
+class Scanner(object):
+    """
+    The position of one scan through a Recognizer.
+
+    state holds the current FSM state, so a Scanner can also be moved one
+    event at a time with recognizer.fsm.move.
+    """
+
+    def __init__(self, recognizer):
+        self.recognizer = recognizer
+        self.state = recognizer.fsm.states.default()
+
+    def feed(self, data):
+        """
+        Advance over a chunk of bytes.
+
+        Returns False once no pattern can match, so callers can stop reading.
+        """
+        r = self.recognizer
+        table = r.table
+        n = r.nclasses
+        reject = int(r.fsm.states.Reject)
+        state = int(self.state)
+        for k in bytes(data).translate(r.classes):
+            state = table[state * n + k]
+            if state == reject:
+                break
+        self.state = r.fsm.states(state)
+        return state != reject
+
+    def finish(self):
+        """
+        Return the patterns that match the input fed so far, in given order.
+        """
+        accepted = self.recognizer.accepts[int(self.state)]
+        return [p for i, p in enumerate(self.recognizer.patterns) if i in accepted]
+
+
+if __name__ == '__main__':
+    recognizer = Recognizer(sys.argv[2:])
+    for pattern in recognizer.match_file(sys.argv[1]):
+        print(pattern)
@@ -0,0 +1,171 @@
+from collections import deque
+
+from enums import UniqueIntEnum
+
+
+class CompositeState(UniqueIntEnum):
+    """
+    Base class for the flat states generated by flatten().
+
+    The first generated member is always the initial configuration.
+    """
+
+    @classmethod
+    def default(cls):
+        return cls(1)
+
+
+class Region(object):
+    """
+    Wrap a plain FSM so it can take part in a statechart.
+
+    The region starts in the default state of the FSM and reacts to events by
+    name, so events from different machines that share a name are the same
+    statechart event.
+    """
+
+    def __init__(self, fsm):
+        self.fsm = fsm
+        self.events = dict((e.name, e) for e in fsm.events)
+
+    def initial(self):
+        return self.fsm.states.default()
+
+    def step(self, config, name):
+        event = self.events.get(name)
+        if event is None:
+            return None
+        return self.fsm.peek(config, event)
+
+    def label(self, config):
+        return config.name
+
+    def event_names(self):
+        return set(self.events)
+
+
+class Nested(object):
+    """
+    Nest child machines inside states of a parent machine.
+
+    children maps parent states to Region, Nested or Parallel nodes. While
+    the parent is in one of those states, the child sees each event first;
+    only events the child cannot handle are offered to the parent. Entering
+    a parent state always starts its child from the initial configuration.
+    """
+
+    def __init__(self, parent, children):
+        self.parent = parent
+        self.children = children
+
+    def initial(self):
+        state = self.parent.initial()
+        return (state, self._enter(state))
+
+    def step(self, config, name):
+        state, child = config
+        if child is not None:
+            child = self.children[state].step(child, name)
+            if child is not None:
+                return (state, child)
+        state = self.parent.step(state, name)
+        if state is None:
+            return None
+        return (state, self._enter(state))
+
+    def label(self, config):
+        state, child = config
+        if child is None:
+            return self.parent.label(state)
+        return self.parent.label(state) + '.' + self.children[state].label(child)
+
+    def event_names(self):
+        names = self.parent.event_names()
+        for child in self.children.values():
+            names |= child.event_names()
+        return names
+
+    def _enter(self, state):
+        child = self.children.get(state)
+        return child.initial() if child is not None else None
+
+
+class Parallel(object):
+    """
+    Run several machines side by side as orthogonal regions.
+
+    An event moves every region that has a transition for it and leaves the
+    others where they are. The event is rejected only if no region moves.
+    """
+
+    def __init__(self, *regions):
+        self.regions = regions
+
+    def initial(self):
+        return tuple(r.initial() for r in self.regions)
+
+    def step(self, config, name):
+        moved = False
+        result = []
+        for region, child in zip(self.regions, config):
+            next_child = region.step(child, name)
+            if next_child is None:
+                result.append(child)
+            else:
+                result.append(next_child)
+                moved = True
+        return tuple(result) if moved else None
+
+    def label(self, config):
+        return '|'.join(r.label(c) for r, c in zip(self.regions, config))
+
+    def event_names(self):
+        names = set()
+        for region in self.regions:
+            names |= region.event_names()
+        return names
+
+
+def flatten(root, name, module):
+    """
+    Compile a statechart into a flat state enum, event enum and transitions.
+
+    Only configurations reachable from the initial one become states, so the
+    result is usually far smaller than the full product of all regions. The
+    transitions are in the same format as FSM.transitions, so every move on
+    the compiled machine is a single dict lookup however deeply the chart is
+    composed.
+
+    The enums are named name + 'State' and name + 'Event' and must be bound
+    to those names in module so that states can be pickled.
+    """
+    names = sorted(root.event_names())
+    initial = root.initial()
+    configs = [initial]
+    index = {initial: 1}
+    edges = []
+    queue = deque([initial])
+    while queue:
+        config = queue.popleft()
+        for event in names:
+            target = root.step(config, event)
+            if target is None:
+                continue
+            if target not in index:
+                index[target] = len(configs) + 1
+                configs.append(target)
+                queue.append(target)
+            edges.append((config, event, target))
+
+    states = CompositeState(name + 'State',
+                            [(root.label(c), index[c]) for c in configs],
+                            module=module)
+    events = UniqueIntEnum(name + 'Event',
+                           [(e, i) for i, e in enumerate(names, 1)],
+                           module=module)
+    transitions = {}
+    for config0, event, config1 in edges:
+        state0 = states(index[config0])
+        state1 = states(index[config1])
+        transitions[(state0, events[event])] = dict(state=state1, data=None)
+    return states, events, transitions
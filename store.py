@@ -0,0 +1,320 @@
+import pickle
+import shelve
+import threading
+import time
+import zlib
+
+from enums import UniqueIntEnum
+
+
+class Durability(UniqueIntEnum):
+    """
+    How eagerly a WriteBehindStore commits buffered writes to disk.
+
+    Lazy only commits when the store is synced or closed. Group commits once
+    enough writes are pending or the oldest pending write is old enough.
+    Immediate commits every write before returning.
+    """
+    Lazy = 1
+    Group = 2
+    Immediate = 3
+
+
+# Marks a pending delete in WriteBehindStore.pending.
+_DELETED = object()
+
+
+class ColdStore(object):
+    """
+    A shelve of zlib-compressed pickles for entities that have gone idle.
+    """
+
+    def __init__(self, filename, level=6, flag='c'):
+        self.shelf = shelve.open(filename, flag=flag)
+        self.level = level
+
+    def __contains__(self, key):
+        return key in self.shelf
+
+    def __delitem__(self, key):
+        del self.shelf[key]
+
+    def keys(self):
+        return list(self.shelf.keys())
+
+    def get(self, key, default=None):
+        try:
+            data = self.shelf[key]
+        except KeyError:
+            return default
+        return pickle.loads(zlib.decompress(data))
+
+    def put(self, key, value):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self.shelf[key] = zlib.compress(data, self.level)
+
+    def pop(self, key, default=None):
+        try:
+            data = self.shelf.pop(key)
+        except KeyError:
+            return default
+        return pickle.loads(zlib.decompress(data))
+
+    def sync(self):
+        self.shelf.sync()
+
+    def close(self):
+        self.shelf.close()
+
+
+class WriteBehindStore(object):
+    """
+    A shelve wrapper that buffers writes and commits them in groups.
+
+    Writes to the same key are coalesced in memory, so only the latest value
+    for each key reaches the shelve. With Group durability, pending writes are
+    committed and synced once max_pending keys are dirty or max_delay seconds
+    have passed since the first uncommitted write, which bounds how much a
+    crash can lose. Reads see buffered writes before they are committed.
+
+    Stored values are replaced, never mutated in place: assign a new value to
+    a key to change it.
+
+    If a ColdStore is given, keys missing from the shelve are looked up there
+    and moved back on first access, so entities moved out by expire() are
+    still readable. The cold copy is kept until the move back is committed.
+    """
+
+    def __init__(self, filename, durability=Durability.Group, max_pending=256,
+                 max_delay=1.0, cold=None, **kwargs):
+        self.shelf = shelve.open(filename, **kwargs)
+        self.cold = cold
+        self.durability = durability
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+        self.pending = {}
+        self.commits = 0
+        # Keys copied out of the cold store whose hot copy is not yet committed.
+        self._faulted = set()
+        self._since = None
+        self._lock = threading.RLock()
+        self._closed = threading.Event()
+        self._flusher = None
+        if durability == Durability.Group:
+            self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+            self._flusher.start()
+
+    def __contains__(self, key):
+        with self._lock:
+            if self._peek(key) is not _DELETED:
+                return True
+            return self.cold is not None and key in self.cold
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = self._peek(key)
+            if value is not _DELETED:
+                return value
+            if self.cold is not None:
+                value = self.cold.get(key, _DELETED)
+                if value is not _DELETED:
+                    self._faulted.add(key)
+                    self._write(key, value)
+                    return value
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._write(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            if self._peek(key) is _DELETED:
+                raise KeyError(key)
+            self._write(key, _DELETED)
+
+    def touch(self, key, now=None):
+        """
+        Set the 'accessed' item of the current value for key.
+
+        The value is re-read under the store lock, so a concurrent write to
+        the same key is never replaced by an older value.
+        """
+        with self._lock:
+            value = self[key]
+            self._write(key, dict(value, accessed=time.time() if now is None else now))
+
+    def keys(self):
+        """
+        Return a snapshot list of the keys in the shelve, excluding cold ones.
+        """
+        with self._lock:
+            keys = set(self.shelf.keys())
+            for key, value in self.pending.items():
+                if value is _DELETED:
+                    keys.discard(key)
+                else:
+                    keys.add(key)
+            return list(keys)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                return self[key]
+            except KeyError:
+                return default
+
+    def setdefault(self, key, default=None):
+        with self._lock:
+            try:
+                return self[key]
+            except KeyError:
+                self[key] = default
+                return default
+
+    def sync(self):
+        """
+        Commit all pending writes to the shelve and flush it to disk.
+
+        Entities faulted in from the cold store are only removed from it once
+        their copy in the shelve has been committed.
+        """
+        with self._lock:
+            if not self.pending:
+                return
+            for key, value in self.pending.items():
+                if value is not _DELETED:
+                    self.shelf[key] = value
+                elif key in self.shelf:
+                    del self.shelf[key]
+            self.shelf.sync()
+            if self._faulted:
+                for key in self._faulted:
+                    if key in self.cold:
+                        del self.cold[key]
+                self.cold.sync()
+                self._faulted.clear()
+            self.pending.clear()
+            self._since = None
+            self.commits += 1
+
+    def close(self):
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        with self._lock:
+            self.sync()
+            self.shelf.close()
+            if self.cold is not None:
+                self.cold.close()
+
+    def expire(self, ttl, evictable, idle=None, now=None, batch=256):
+        """
+        Delete or move out entries that have not been accessed recently.
+
+        Values are dicts whose 'accessed' item holds the time of last access.
+        Entries idle for at least ttl seconds are deleted if evictable(key,
+        value) is true, whether they are in the shelve or the cold store.
+        Entries that are not evictable and have been idle for at least idle
+        seconds are moved to the cold store, if there is one. Evictable
+        entries stay put until they expire. The store is only locked for one
+        batch of keys at a time.
+
+        Returns the number of entries deleted and moved.
+        """
+        now = time.time() if now is None else now
+        evicted = moved = 0
+        keys = self.keys()
+        for i in range(0, len(keys), batch):
+            with self._lock:
+                doomed = []
+                cooled = []
+                for key in keys[i:i + batch]:
+                    value = self._peek(key)
+                    if value is _DELETED:
+                        continue
+                    age = now - value.get('accessed', 0)
+                    if evictable(key, value):
+                        if age >= ttl:
+                            doomed.append(key)
+                    elif self.cold is not None and idle is not None and age >= idle:
+                        self.cold.put(key, value)
+                        self._faulted.discard(key)
+                        cooled.append(key)
+                if cooled:
+                    self.cold.sync()
+                for key in doomed + cooled:
+                    self._write(key, _DELETED)
+                evicted += len(doomed)
+                moved += len(cooled)
+        if self.cold is not None:
+            evicted += self._expire_cold(ttl, evictable, now, batch)
+        return evicted, moved
+
+    def _expire_cold(self, ttl, evictable, now, batch):
+        evicted = 0
+        keys = self.cold.keys()
+        for i in range(0, len(keys), batch):
+            with self._lock:
+                for key in keys[i:i + batch]:
+                    if key in self._faulted:
+                        continue
+                    value = self.cold.get(key)
+                    if value is None:
+                        continue
+                    if now - value.get('accessed', 0) >= ttl and evictable(key, value):
+                        del self.cold[key]
+                        evicted += 1
+                self.cold.sync()
+        return evicted
+
+    def _peek(self, key):
+        if key in self.pending:
+            return self.pending[key]
+        try:
+            return self.shelf[key]
+        except KeyError:
+            return _DELETED
+
+    def _write(self, key, value):
+        if not self.pending:
+            self._since = time.monotonic()
+        self.pending[key] = value
+        if self.durability == Durability.Immediate:
+            self.sync()
+        elif self.durability == Durability.Group and self._due():
+            self.sync()
+
+    def _due(self):
+        if len(self.pending) >= self.max_pending:
+            return True
+        return self._since is not None and time.monotonic() - self._since >= self.max_delay
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.max_delay / 2):
+            with self._lock:
+                if self._due():
+                    self.sync()
+
+
+class TransitionLog(object):
+    """
+    An append-only log of state transitions for offline analysis.
+
+    Each line holds the time, machine name, entity pk, previous state, event
+    and new state, with states and events written as integers. Creating an
+    entity is logged with event 0 and its initial state on both sides.
+    """
+
+    def __init__(self, filename):
+        self.file = open(filename, 'a', buffering=1)
+        self._lock = threading.Lock()
+
+    def append(self, name, pk, state0, event, state1):
+        line = '%.6f,%s,%s,%d,%d,%d\n' % (time.time(), name, pk, state0, event, state1)
+        with self._lock:
+            self.file.write(line)
+
+    def close(self):
+        with self._lock:
+            self.file.close()